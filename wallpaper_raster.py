@@ -1,14 +1,35 @@
 """Tile a raster by another raster in an area defined by a mask."""
 import argparse
+import concurrent.futures
+import functools
 import logging
+import math
 import os
 import sys
+import threading
 
 from osgeo import gdal
 import pygeoprocessing
 import numpy
 
-gdal.SetCacheMax(2**27)
+try:
+    import numba
+except ImportError:
+    numba = None
+
+GDAL_CACHE_MAX = 2**27
+gdal.SetCacheMax(GDAL_CACHE_MAX)
+
+# per core L2 size that in-memory work on a block is chunked to fit in
+L2_CACHE_BYTES = 2**18
+
+# targets are written a whole number of these tiles at a time
+TARGET_BLOCK_SIZE = (256, 256)
+GTIFF_CREATION_OPTIONS = (
+    'TILED=YES', 'BIGTIFF=IF_SAFER', 'COMPRESS=LZW',
+    f'BLOCKXSIZE={TARGET_BLOCK_SIZE[0]}',
+    f'BLOCKYSIZE={TARGET_BLOCK_SIZE[1]}', 'NUM_THREADS=ALL_CPUS',
+    'COPY_SRC_OVERVIEWS=NO')
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -18,6 +39,8 @@ logging.basicConfig(
     stream=sys.stdout)
 
 LOGGER = logging.getLogger(__name__)
+# numba logs its whole compilation pipeline at DEBUG
+logging.getLogger('numba').setLevel(logging.INFO)
 
 
 def _makedirs(dir_path):
@@ -35,34 +58,80 @@ def _get_vector_fields(vector_path, field_name):
     return {feature.GetField(field_name) for feature in layer}
 
 
-def _extract_intersecting_array_from_raster(
-        feature, feature_projection_wkt, raster_path):
-    """Extract numpy array from the raster that intersects with the feature.
+@functools.lru_cache(maxsize=None)
+def _get_raster_info(raster_path):
+    """Return `pygeoprocessing.get_raster_info`, cached by `raster_path`.
+
+    Only use on rasters that are not modified while the script runs, the
+    returned dict is shared between callers.
+
+    """
+    return pygeoprocessing.get_raster_info(raster_path)
+
+
+@functools.lru_cache(maxsize=None)
+def _transform_bounding_box(
+        bounding_box, base_projection_wkt, target_projection_wkt):
+    """Return `pygeoprocessing.transform_bounding_box`, cached by arguments.
+
+    Rasters often share a projection so the same scenario bounding box is
+    transformed over and over otherwise.
 
     Args:
-        feature (ogr.Feature): feature to use as a georeference to extract
-            the array.
-        feature_projection_wkt (str): a WKT form of the feature SRS.
-        raster_path (str): path to raster to extract the intersecting
-            bounding box from.
+        bounding_box (tuple): (x_min, y_min, x_max, y_max) in
+            `base_projection_wkt`.
+        base_projection_wkt (str): a WKT form of the bounding box SRS.
+        target_projection_wkt (str): a WKT form of the SRS to transform to.
+
+    Returns:
+        (x_min, y_min, x_max, y_max) tuple in `target_projection_wkt`.
 
     """
-    raster_info = pygeoprocessing.get_raster_info(raster_path)
-    raster_info = pygeoprocessing.get_raster_info(raster_path)
-    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
-    raster_gt_inv = gdal.InvGeoTransform(raster_info['geotransform'])
+    return tuple(pygeoprocessing.transform_bounding_box(
+        list(bounding_box), base_projection_wkt, target_projection_wkt))
+
+
+def _get_feature_boundaries(feature_list):
+    """Return the bounding boxes of a list of features as one array.
 
-    # get the boundary of the feature in non-interleaved format,
+    Args:
+        feature_list (list): list of ogr.Features.
+
+    Returns:
+        numpy.ndarray of shape (len(feature_list), 4) where each row is
+        (x_min, y_min, x_max, y_max) of the corresponding feature.
+
+    """
+    # get the boundary of the features in non-interleaved format,
     # .GetEnvelope returns in interleaved i.e.
     # (x_min, x_max, y_min, y_max) to
     # (x_min, y_min, x_max, y_max)
-    scenario_boundary = [
-        feature.GetGeometryRef().GetEnvelope()[i]
-        for i in [0, 2, 1, 3]]
-    scenario_bb = pygeoprocessing.transform_bounding_box(
-        scenario_boundary,
-        feature_projection_wkt,
-        raster_info['projection_wkt'])
+    envelope_array = numpy.array(
+        [feature.GetGeometryRef().GetEnvelope() for feature in feature_list],
+        dtype=numpy.float64).reshape((-1, 4))
+    return envelope_array[:, [0, 2, 1, 3]]
+
+
+def _get_intersecting_window(
+        boundary, boundary_projection_wkt, raster_projection_wkt,
+        raster_gt_inv):
+    """Calculate the pixel window of the raster that intersects a boundary.
+
+    Args:
+        boundary (sequence): (x_min, y_min, x_max, y_max) bounding box to
+            use as a georeference for the window.
+        boundary_projection_wkt (str): a WKT form of the boundary SRS.
+        raster_projection_wkt (str): a WKT form of the raster SRS.
+        raster_gt_inv (list): inverse geotransform of the raster.
+
+    Returns:
+        (x_min, y_min, x_max, y_max) pixel bounds of the window.
+
+    """
+    scenario_bb = _transform_bounding_box(
+        tuple(float(v) for v in boundary),
+        boundary_projection_wkt,
+        raster_projection_wkt)
 
     x_min, y_min = [
         int(v) for v in gdal.ApplyGeoTransform(
@@ -70,88 +139,622 @@ def _extract_intersecting_array_from_raster(
     x_max, y_max = [
         int(v) for v in gdal.ApplyGeoTransform(
             raster_gt_inv, scenario_bb[2], scenario_bb[1])]
+    return x_min, y_min, x_max, y_max
 
-    array = raster.ReadAsArray(
-        xoff=x_min, yoff=y_min, xsize=x_max-x_min, ysize=y_max-y_min)
-    return array
 
+def _window_area(window):
+    """Return the pixel area of a (x_min, y_min, x_max, y_max) window."""
+    return (window[2]-window[0]) * (window[3]-window[1])
 
-def _create_vector_mask(
-        base_raster_path, vector_path, target_mask_raster_path):
-    """Create a nodata/1 mask of `raster` that is 1 where vector covers.
+
+def _read_windows(raster, window_list):
+    """Read arrays for many windows, sharing reads between nearby windows.
+
+    Windows are swept in (y_min, x_min) order and each is merged into the
+    group before it when their combined bounding box is no larger than
+    reading them separately (i.e. they overlap or abut), merged groups are
+    read once and sliced apart afterwards.
+
+    Args:
+        raster (gdal.Dataset): raster to read from.
+        window_list (list): list of (x_min, y_min, x_max, y_max) pixel
+            windows.
+
+    Returns:
+        list of numpy.ndarrays in the same order as `window_list`, these may
+        be views into a shared array.
+
+    """
+    # each group is [union window, list of window indexes]
+    group_list = []
+    for window_index in sorted(
+            range(len(window_list)),
+            key=lambda index: (window_list[index][1], window_list[index][0])):
+        window = window_list[window_index]
+        if group_list:
+            group_window = group_list[-1][0]
+            union_window = (
+                min(group_window[0], window[0]),
+                min(group_window[1], window[1]),
+                max(group_window[2], window[2]),
+                max(group_window[3], window[3]))
+            if _window_area(union_window) <= (
+                    _window_area(group_window) + _window_area(window)):
+                group_list[-1][0] = union_window
+                group_list[-1][1].append(window_index)
+                continue
+        group_list.append([window, [window_index]])
+
+    array_list = [None] * len(window_list)
+    for (x_min, y_min, x_max, y_max), window_index_list in group_list:
+        group_array = raster.ReadAsArray(
+            xoff=x_min, yoff=y_min, xsize=x_max-x_min, ysize=y_max-y_min)
+        for window_index in window_index_list:
+            window = window_list[window_index]
+            array_list[window_index] = group_array[
+                window[1]-y_min:window[3]-y_min,
+                window[0]-x_min:window[2]-x_min]
+    return array_list
+
+
+def _create_vector_mask(base_raster_path, vector_path):
+    """Create a packed 0/1 bitmap of `raster` that is 1 where vector covers.
 
     Args:
         base_raster_path (str): path to base raster to use as size/projection
-            for `target_mask_raster_path`.
+            for the mask.
         vector_path (str): path to vector to use as mask for base
-        target_mask_raster_path (str): file that is created that is nodata
-            by default and 1 where vector intersects.
+
+    Returns:
+        numpy.ndarray of uint8 with one row per raster row and each row
+        packed 8 pixels to a byte with `numpy.packbits`, bits are 0 by default
+        and 1 where vector intersects.
+
+    """
+    base_info = _get_raster_info(base_raster_path)
+    n_cols, n_rows = base_info['raster_size']
+    gt = base_info['geotransform']
+
+    # rasterize a strip of rows at a time into a small MEM raster so only
+    # one strip is ever unpacked, its origin is moved down to each strip
+    strip_ysize = min(n_rows, max(1, GDAL_CACHE_MAX // n_cols))
+    mem_driver = gdal.GetDriverByName('MEM')
+    mask_raster = mem_driver.Create(
+        '', n_cols, strip_ysize, 1, gdal.GDT_Byte)
+    mask_raster.SetProjection(base_info['projection_wkt'])
+    mask_band = mask_raster.GetRasterBand(1)
+    mask_band.SetNoDataValue(0)
+    strip_array = numpy.empty((strip_ysize, n_cols), dtype=numpy.uint8)
+
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+
+    # the mask is only 0/1 so pack it to a bit per pixel
+    packed_mask = numpy.empty((n_rows, -(-n_cols // 8)), dtype=numpy.uint8)
+    for offset_dict in _iterate_windows(
+            (n_cols, n_rows), (n_cols, strip_ysize)):
+        yoff = offset_dict['yoff']
+        win_ysize = offset_dict['win_ysize']
+        mask_raster.SetGeoTransform((
+            gt[0] + yoff * gt[2], gt[1], gt[2],
+            gt[3] + yoff * gt[5], gt[4], gt[5]))
+        mask_band.Fill(0)
+        gdal.RasterizeLayer(mask_raster, [1], layer, burn_values=[1])
+        mask_band.ReadAsArray(buf_obj=strip_array)
+        packed_mask[yoff:yoff+win_ysize, :] = numpy.packbits(
+            strip_array[:win_ysize], axis=1)
+    return packed_mask
+
+
+def _unpack_mask_window(
+        packed_mask, xoff, yoff, win_xsize, win_ysize):
+    """Unpack a window of a mask packed by `_create_vector_mask`.
+
+    Args:
+        packed_mask (numpy.ndarray): row-wise `numpy.packbits` bitmap.
+        xoff, yoff (int): pixel offset of the window.
+        win_xsize, win_ysize (int): pixel size of the window.
+
+    Returns:
+        0/1 uint8 numpy.ndarray of shape (win_ysize, win_xsize).
+
+    """
+    # only unpack the bytes that hold the window's columns
+    byte_start = xoff // 8
+    byte_end = -(-(xoff + win_xsize) // 8)
+    bit_offset = xoff - byte_start * 8
+    unpacked_array = numpy.unpackbits(
+        packed_mask[yoff:yoff+win_ysize, byte_start:byte_end], axis=1)
+    return unpacked_array[:, bit_offset:bit_offset+win_xsize]
+
+
+def _copy_period_tile(target_array, period_tile):
+    """Repeat `period_tile` over `target_array` one tile at a time.
+
+    Each tile sized piece of `target_array` is written from the same small
+    `period_tile` so it stays in cache rather than streaming a target sized
+    tiled array through memory.
+
+    Args:
+        target_array (numpy.ndarray): array to write to, its upper left
+            pixel lines up with the upper left pixel of `period_tile`.
+        period_tile (numpy.ndarray): tile to repeat.
 
     Returns:
         None.
 
     """
-    pygeoprocessing.new_raster_from_base(
-        base_raster_path, target_mask_raster_path, gdal.GDT_Byte, [0])
-    pygeoprocessing.rasterize(
-        vector_path, target_mask_raster_path, burn_values=[1])
+    tile_ysize, tile_xsize = period_tile.shape
+    for yoff in range(0, target_array.shape[0], tile_ysize):
+        for xoff in range(0, target_array.shape[1], tile_xsize):
+            target_view = target_array[
+                yoff:yoff+tile_ysize, xoff:xoff+tile_xsize]
+            numpy.copyto(
+                target_view,
+                period_tile[:target_view.shape[0], :target_view.shape[1]])
+
+
+def _iterate_chunks(window_size, cell_size, max_chunk_pixels):
+    """Yield chunks of a window that fit a pixel budget and stay in a cell.
+
+    Args:
+        window_size (tuple): (win_xsize, win_ysize) of the window to chunk.
+        cell_size (tuple): (cell_xsize, cell_ysize), no chunk crosses a
+            multiple of this from the window's upper left pixel.
+        max_chunk_pixels (int): upper bound on the pixels in a chunk.
+
+    Yields:
+        `iterblocks` style offset dicts relative to the window's upper left
+        pixel, in row major order within each cell.
+
+    """
+    cell_xsize = min(cell_size[0], window_size[0])
+    cell_ysize = min(cell_size[1], window_size[1])
+    # split x only when a single row won't fit to keep row major locality
+    chunk_xsize = max(1, min(cell_xsize, max_chunk_pixels))
+    chunk_ysize = max(1, min(cell_ysize, max_chunk_pixels // chunk_xsize))
+    for cell_dict in _iterate_windows(window_size, (cell_xsize, cell_ysize)):
+        for chunk_dict in _iterate_windows(
+                (cell_dict['win_xsize'], cell_dict['win_ysize']),
+                (chunk_xsize, chunk_ysize)):
+            chunk_dict['xoff'] += cell_dict['xoff']
+            chunk_dict['yoff'] += cell_dict['yoff']
+            yield chunk_dict
+
+
+def _aligned_block_size(raster_size, period_size, max_block_pixels):
+    """Calculate a block size that is a whole multiple of `period_size`.
+
+    Args:
+        raster_size (tuple): (n_cols, n_rows) of the raster to iterate over.
+        period_size (tuple): (x_period, y_period) that block sizes should be
+            a multiple of, such as a GDAL block size or wallpaper shape.
+        max_block_pixels (int): upper bound on the number of pixels in a
+            block.
+
+    Returns:
+        (block_xsize, block_ysize) tuple. If a single period fits in
+        `max_block_pixels` the block is an integer number of periods along
+        each axis, otherwise it is a full width strip (or as wide as will
+        fit) that does not align with the period.
+
+    """
+    n_cols, n_rows = raster_size
+    x_period, y_period = period_size
+    period_pixels = x_period * y_period
+    if period_pixels <= max_block_pixels:
+        # grow along x first to keep row major locality
+        x_repeats = max(1, min(
+            -(-n_cols // x_period), max_block_pixels // period_pixels))
+        y_repeats = max(1, min(
+            -(-n_rows // y_period),
+            max_block_pixels // (x_repeats * period_pixels)))
+        return x_repeats * x_period, y_repeats * y_period
+    block_xsize = max(1, min(n_cols, max_block_pixels))
+    block_ysize = max(1, min(n_rows, max_block_pixels // block_xsize))
+    return block_xsize, block_ysize
+
+
+def _iterate_windows(raster_size, block_size):
+    """Yield `iterblocks` style offset dicts over a raster.
+
+    Args:
+        raster_size (tuple): (n_cols, n_rows) of the raster to iterate over.
+        block_size (tuple): (block_xsize, block_ysize) of the windows, edge
+            windows are clipped to the raster.
+
+    Yields:
+        dict with 'xoff', 'yoff', 'win_xsize', and 'win_ysize' keys.
+
+    """
+    n_cols, n_rows = raster_size
+    block_xsize, block_ysize = block_size
+    for yoff in range(0, n_rows, block_ysize):
+        win_ysize = min(block_ysize, n_rows - yoff)
+        for xoff in range(0, n_cols, block_xsize):
+            yield {
+                'xoff': xoff,
+                'yoff': yoff,
+                'win_xsize': min(block_xsize, n_cols - xoff),
+                'win_ysize': win_ysize,
+            }
+
+
+def _spread_bits(value):
+    """Spread the low 32 bits of `value` out to the even bits of 64."""
+    value &= 0xFFFFFFFF
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def _morton_code(x_index, y_index):
+    """Return the z-order curve index of a 2D block index."""
+    return _spread_bits(x_index) | (_spread_bits(y_index) << 1)
+
+
+def _wallpaper_indexes(
+        wallpaper_shape, wallpaper_x, wallpaper_y, win_xsize, win_ysize):
+    """Calculate the wallpaper row/col that lands on each pixel of a window.
+
+    Args:
+        wallpaper_shape (tuple): (n_rows, n_cols) of the wallpaper array.
+        wallpaper_x, wallpaper_y (int): offset into the wallpaper that lands
+            on the upper left pixel of the window.
+        win_xsize, win_ysize (int): size of the window.
+
+    Returns:
+        (row_index, col_index) tuple of 1D numpy.ndarrays of length
+        `win_ysize` and `win_xsize`.
+
+    """
+    # read the shared cache once so a worker regrowing it can't swap it out
+    # from under this call
+    arange_cache = _wallpaper_indexes.arange_cache
+    if arange_cache.size < max(win_xsize, win_ysize):
+        arange_cache = numpy.arange(max(win_xsize, win_ysize))
+        _wallpaper_indexes.arange_cache = arange_cache
+    row_index = (wallpaper_y + arange_cache[:win_ysize]) % wallpaper_shape[0]
+    col_index = (wallpaper_x + arange_cache[:win_xsize]) % wallpaper_shape[1]
+    return row_index, col_index
+
+
+# reused across calls so each block doesn't allocate its own arange
+_wallpaper_indexes.arange_cache = numpy.arange(0)
+
+
+def _tile_wallpaper(
+        wallpaper_array, wallpaper_x, wallpaper_y, win_xsize, win_ysize):
+    """Tile `wallpaper_array` over a window starting at a wallpaper offset.
+
+    Args:
+        wallpaper_array (numpy.ndarray): array to tile.
+        wallpaper_x, wallpaper_y (int): offset into `wallpaper_array` that
+            lands on the upper left pixel of the window.
+        win_xsize, win_ysize (int): size of the window.
+
+    Returns:
+        numpy.ndarray of shape (win_ysize, win_xsize).
+
+    """
+    # gather the wallpaper window with modulo row/col indexes rather
+    # than materializing a numpy.tile that is larger than the block
+    row_index, col_index = _wallpaper_indexes(
+        wallpaper_array.shape, wallpaper_x, wallpaper_y, win_xsize,
+        win_ysize)
+    return wallpaper_array[row_index[:, None], col_index[None, :]]
+
+
+if numba is not None:
+    # blocks are already spread over a thread pool so the kernel releases
+    # the GIL rather than using numba's own (not thread safe) parallelism
+    @numba.njit(nogil=True, boundscheck=False, fastmath=True, cache=True)
+    def _apply_block(base, mask, wallpaper, row_index, col_index, out):
+        """Write wallpaper where `mask` is set and `base` elsewhere to `out`.
+
+        Args:
+            base (numpy.ndarray): base block.
+            mask (numpy.ndarray): 0/1 block, same shape as `base`.
+            wallpaper (numpy.ndarray): untiled wallpaper array.
+            row_index, col_index (numpy.ndarray): wallpaper row for each
+                block row and wallpaper column for each block column, see
+                `_wallpaper_indexes`.
+            out (numpy.ndarray): array to write to, may be `base`.
+
+        Returns:
+            None.
+
+        """
+        for i in range(out.shape[0]):
+            wallpaper_row = wallpaper[row_index[i]]
+            for j in range(out.shape[1]):
+                if mask[i, j]:
+                    out[i, j] = wallpaper_row[col_index[j]]
+                else:
+                    out[i, j] = base[i, j]
 
 
 def _wallpaper_raster(
-        base_raster_path, mask_raster_path, wallpaper_array,
+        base_raster_path, mask_raster, wallpaper_array,
         target_raster_path):
     """Wallpaper array to base via masked raster.
 
     Args:
         base_raster_path (str): path to base raster that is used as the
             non-mask raster.
-        mask_raster_path (str): path to raster containing 1s where base should
-            be wallpapered with array
+        mask_raster (str or numpy.ndarray): path to a raster, or a packed
+            bitmap from `_create_vector_mask`, containing 1s where base
+            should be wallpapered with array
         target_raster_path (str): path to desired target raster.
 
     Returns:
         None
 
     """
-    mask_raster = gdal.OpenEx(mask_raster_path, gdal.OF_RASTER)
-    mask_band = mask_raster.GetRasterBand(1)
-
-    base_info = pygeoprocessing.get_raster_info(base_raster_path)
-    pygeoprocessing.new_raster_from_base(
-        base_raster_path, target_raster_path,
-        base_info['datatype'], base_info['nodata'])
-    target_raster = gdal.OpenEx(
-        target_raster_path, gdal.OF_RASTER | gdal.GA_Update)
+    base_raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
+    base_info = _get_raster_info(base_raster_path)
+
+    # keep every intermediate in the (possibly smaller) base type
+    wallpaper_array = wallpaper_array.astype(
+        base_info['numpy_type'], copy=False)
+
+    # start from a copy of the base so only blocks touched by the mask need
+    # to be written, floating point predictor is only valid on float types
+    if base_info['datatype'] in (gdal.GDT_Float32, gdal.GDT_Float64):
+        predictor_option = 'PREDICTOR=3'
+    else:
+        predictor_option = 'PREDICTOR=2'
+    target_raster = gdal.Translate(
+        target_raster_path, base_raster, format='GTiff',
+        creationOptions=list(GTIFF_CREATION_OPTIONS) + [predictor_option])
     target_band = target_raster.GetRasterBand(1)
 
-    for offset_dict, base_array in pygeoprocessing.iterblocks(
-            (base_raster_path, 1)):
-        mask_array = mask_band.ReadAsArray(**offset_dict)
+    # size blocks so base, mask, wallpaper, and target blocks for every
+    # worker together fit in the GDAL cache
+    n_workers = os.cpu_count() or 1
+    pixel_bytes = 3 * wallpaper_array.itemsize + 1
+    max_block_pixels = gdal.GetCacheMax() // (pixel_bytes * n_workers)
+    # base, mask, wallpaper, and target strips of this many pixels fit in L2
+    l2_block_pixels = L2_CACHE_BYTES // (4 * wallpaper_array.itemsize)
+
+    # windows that cover whole target blocks are written without GDAL
+    # reading back partial blocks, prefer those that also cover whole
+    # wallpaper repeats and otherwise just align to the target blocks
+    target_block_xsize, target_block_ysize = target_band.GetBlockSize()
+    period_size = (
+        math.lcm(target_block_xsize, wallpaper_array.shape[1]),
+        math.lcm(target_block_ysize, wallpaper_array.shape[0]))
+    if period_size[0] * period_size[1] > max_block_pixels:
+        period_size = (target_block_xsize, target_block_ysize)
+    block_xsize, block_ysize = _aligned_block_size(
+        base_info['raster_size'], period_size, max_block_pixels)
+
+    # only the wallpaper phase and window size determine a tile so blocks
+    # that share them reuse the same array, bounded to about the GDAL cache
+    @functools.lru_cache(maxsize=max(1, gdal.GetCacheMax() // (
+        block_xsize * block_ysize * wallpaper_array.itemsize)))
+    def _make_tile(wallpaper_x, wallpaper_y, win_xsize, win_ysize):
+        tile_array = _tile_wallpaper(
+            wallpaper_array, wallpaper_x, wallpaper_y, win_xsize, win_ysize)
+        tile_array.setflags(write=False)
+        return tile_array
+
+    # when the period covers whole wallpaper repeats every window starts on
+    # one, so a single period of tiled wallpaper is built up front and
+    # repeated over each window with no modulo work. When the wallpaper
+    # divides the target block size this is just one GDAL block.
+    period_wallpaper = None
+    if (period_size[0] % wallpaper_array.shape[1] == 0 and
+            period_size[1] % wallpaper_array.shape[0] == 0 and
+            block_xsize % period_size[0] == 0 and
+            block_ysize % period_size[1] == 0):
+        period_wallpaper = numpy.tile(
+            wallpaper_array, (
+                period_size[1] // wallpaper_array.shape[0],
+                period_size[0] // wallpaper_array.shape[1]))
+        period_wallpaper.setflags(write=False)
+
+    def _get_tile(xoff, yoff, win_xsize, win_ysize):
+        """Return the read-only wallpaper tile for an unaligned window."""
+        return _make_tile(
+            xoff % wallpaper_array.shape[1],
+            yoff % wallpaper_array.shape[0],
+            win_xsize, win_ysize)
+
+    def _wallpaper_chunk(
+            base_array, chunk_dict, mask_chunk, window_tile, window_index):
+        """Wallpaper a chunk of a window in place.
+
+        Args:
+            base_array (numpy.ndarray): base window to write into.
+            chunk_dict (dict): offset dict of the chunk within the window.
+            mask_chunk (numpy.ndarray): 0/1 mask of the chunk, or None if
+                every pixel in the chunk is wallpapered.
+            window_tile (numpy.ndarray): wallpaper tile of the whole window
+                or None if ``window_index`` or the period wallpaper is used.
+            window_index (tuple): ``(row_index, col_index)`` wallpaper
+                indexes of the whole window or None.
+
+        Returns:
+            None.
+
+        """
+        chunk_xoff = chunk_dict['xoff']
+        chunk_yoff = chunk_dict['yoff']
+        chunk_xsize = chunk_dict['win_xsize']
+        chunk_ysize = chunk_dict['win_ysize']
+        base_chunk = base_array[
+            chunk_yoff:chunk_yoff+chunk_ysize,
+            chunk_xoff:chunk_xoff+chunk_xsize]
+        if period_wallpaper is not None:
+            # the window starts on a period and a chunk never crosses one
+            period_x = chunk_xoff % period_size[0]
+            period_y = chunk_yoff % period_size[1]
+            tile_chunk = period_wallpaper[
+                period_y:period_y+chunk_ysize, period_x:period_x+chunk_xsize]
+        elif window_index is not None:
+            row_index = window_index[0][chunk_yoff:chunk_yoff+chunk_ysize]
+            col_index = window_index[1][chunk_xoff:chunk_xoff+chunk_xsize]
+            if mask_chunk is not None:
+                # fuse the gather and select into one pass over the chunk
+                _apply_block(
+                    base_chunk, mask_chunk, wallpaper_array, row_index,
+                    col_index, base_chunk)
+                return
+            tile_chunk = wallpaper_array[row_index[:, None], col_index]
+        else:
+            tile_chunk = window_tile[
+                chunk_yoff:chunk_yoff+chunk_ysize,
+                chunk_xoff:chunk_xoff+chunk_xsize]
+
+        if mask_chunk is None:
+            numpy.copyto(base_chunk, tile_chunk)
+        else:
+            # mask is 0/1 bytes so a bool view selects without a compare
+            # pass
+            numpy.copyto(
+                base_chunk, tile_chunk, where=mask_chunk.view(bool))
+
+    # GDAL handles aren't thread safe so each worker reads through its own
+    # and writes to the single target band are serialized
+    thread_local = threading.local()
+    target_lock = threading.Lock()
+
+    # a packed bitmap mask is plain memory that workers share, a mask path
+    # gets a handle per worker like the base
+    mask_is_packed = isinstance(mask_raster, numpy.ndarray)
+
+    def _process_block(offset_dict):
+        """Wallpaper the window in `offset_dict` into the target band."""
+        if not hasattr(thread_local, 'base_band'):
+            if not mask_is_packed:
+                thread_local.mask_raster = gdal.OpenEx(
+                    mask_raster, gdal.OF_RASTER)
+                thread_local.mask_band = (
+                    thread_local.mask_raster.GetRasterBand(1))
+            thread_local.base_raster = gdal.OpenEx(
+                base_raster_path, gdal.OF_RASTER)
+            thread_local.base_band = thread_local.base_raster.GetRasterBand(1)
+            # base blocks are read into the same buffer for every block
+            thread_local.base_buffer = numpy.empty(
+                (block_ysize, block_xsize), dtype=wallpaper_array.dtype)
 
         xoff = offset_dict['xoff']
         yoff = offset_dict['yoff']
-
-        wallpaper_x = xoff % wallpaper_array.shape[1]
-        wallpaper_y = yoff % wallpaper_array.shape[0]
-
         win_ysize = offset_dict['win_ysize']
         win_xsize = offset_dict['win_xsize']
-        wallpaper_x_repeats = (
-            1 + ((wallpaper_x+win_xsize) // wallpaper_array.shape[1]))
-        wallpaper_y_repeats = (
-            1 + ((wallpaper_y+win_ysize) // wallpaper_array.shape[0]))
-        wallpaper_tiled = numpy.tile(
-            wallpaper_array,
-            (wallpaper_y_repeats, wallpaper_x_repeats))[
-            wallpaper_y:wallpaper_y+win_ysize,
-            wallpaper_x:wallpaper_x+win_xsize]
 
-        target_array = numpy.where(
-            mask_array == 1,
-            wallpaper_tiled,
-            base_array)
-
-        target_band.WriteArray(target_array, xoff=xoff, yoff=yoff)
+        # the mask is unpacked and selected a chunk at a time so the
+        # chunk's base, mask, wallpaper, and target stay in L2 between
+        # passes, chunks in the period aligned case never cross a period so
+        # each is one slice of the period wallpaper
+        if period_wallpaper is not None:
+            cell_size = period_size
+        else:
+            cell_size = (win_xsize, win_ysize)
+        chunk_list = list(_iterate_chunks(
+            (win_xsize, win_ysize), cell_size, l2_block_pixels))
+
+        if not mask_is_packed:
+            mask_array = thread_local.mask_band.ReadAsArray(**offset_dict)
+
+        def _get_mask_chunk(chunk_dict):
+            """Return the 0/1 mask of a chunk of the window."""
+            chunk_xoff = chunk_dict['xoff']
+            chunk_yoff = chunk_dict['yoff']
+            if mask_is_packed:
+                return _unpack_mask_window(
+                    mask_raster, xoff+chunk_xoff, yoff+chunk_yoff,
+                    chunk_dict['win_xsize'], chunk_dict['win_ysize'])
+            return mask_array[
+                chunk_yoff:chunk_yoff+chunk_dict['win_ysize'],
+                chunk_xoff:chunk_xoff+chunk_dict['win_xsize']]
+
+        # parcels usually cover a small part of the raster so most blocks
+        # are already correct in the copy of the base, zero packed bytes
+        # over the window show that without unpacking any chunk
+        if mask_is_packed and not mask_raster[
+                yoff:yoff+win_ysize,
+                xoff // 8:-(-(xoff + win_xsize) // 8)].any():
+            return
+
+        # stop at the first chunk that shows the block is mixed, every chunk
+        # before it was then uniformly 0 (mask_any is False) or uniformly 1
+        mask_any = False
+        mask_all = True
+        for mixed_index, chunk_dict in enumerate(chunk_list):
+            prefix_all_ones = mask_any
+            mixed_mask_chunk = _get_mask_chunk(chunk_dict)
+            mask_any = mask_any or bool(mixed_mask_chunk.any())
+            mask_all = mask_all and bool(mixed_mask_chunk.all())
+            if mask_any and not mask_all:
+                break
+
+        if not mask_any:
+            return
+
+        # blocks entirely inside the parcels don't need the base at all
+        if mask_all:
+            if period_wallpaper is not None:
+                wallpaper_tiled = thread_local.base_buffer[
+                    :win_ysize, :win_xsize]
+                _copy_period_tile(wallpaper_tiled, period_wallpaper)
+            else:
+                wallpaper_tiled = _get_tile(xoff, yoff, win_xsize, win_ysize)
+            with target_lock:
+                target_band.WriteArray(wallpaper_tiled, xoff=xoff, yoff=yoff)
+            return
+
+        # unaligned windows look up the wallpaper for the whole window once
+        # and every chunk slices it, the numba kernel gathers through the
+        # row/col indexes rather than a materialized tile
+        window_tile = None
+        window_index = None
+        if period_wallpaper is None:
+            if numba is not None:
+                window_index = _wallpaper_indexes(
+                    wallpaper_array.shape,
+                    xoff % wallpaper_array.shape[1],
+                    yoff % wallpaper_array.shape[0],
+                    win_xsize, win_ysize)
+            else:
+                window_tile = _get_tile(xoff, yoff, win_xsize, win_ysize)
+
+        base_array = thread_local.base_band.ReadAsArray(
+            buf_obj=thread_local.base_buffer[:win_ysize, :win_xsize],
+            **offset_dict)
+        for chunk_index, chunk_dict in enumerate(chunk_list):
+            if chunk_index < mixed_index:
+                # already known to be uniform so no need to unpack again
+                if not prefix_all_ones:
+                    continue
+                mask_chunk = None
+            elif chunk_index == mixed_index:
+                mask_chunk = mixed_mask_chunk
+            else:
+                mask_chunk = _get_mask_chunk(chunk_dict)
+            _wallpaper_chunk(
+                base_array, chunk_dict, mask_chunk, window_tile,
+                window_index)
+        with target_lock:
+            target_band.WriteArray(base_array, xoff=xoff, yoff=yoff)
+
+    # process in z-order so neighboring blocks of base and mask, which may
+    # have different internal tiling, are still in the GDAL cache
+    offset_dict_list = sorted(
+        _iterate_windows(
+            base_info['raster_size'], (block_xsize, block_ysize)),
+        key=lambda offset_dict: _morton_code(
+            offset_dict['xoff'] // block_xsize,
+            offset_dict['yoff'] // block_ysize))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_workers) as executor:
+        # consume the results so worker exceptions are raised here
+        for _ in executor.map(_process_block, offset_dict_list):
+            pass
 
 
 def main():
@@ -178,46 +781,66 @@ def main():
 
     _makedirs(args.workspace_dir)
 
+    # every file is opened by name so GDAL doesn't need directory listings
+    # to find siblings, and compression can spread over all cores
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE')
+    gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+
     scenario_vector_info = pygeoprocessing.get_vector_info(
         args.scenarios_vector_path)
 
+    # scenario features are the same for every raster so read them once
+    scenario_vector = gdal.OpenEx(args.scenarios_vector_path, gdal.OF_VECTOR)
+    scenario_layer = scenario_vector.GetLayer()
+    scenario_feature_list = list(scenario_layer)
+    scenario_id_list = [
+        scenario_feature.GetField(args.scenario_id_field)
+        for scenario_feature in scenario_feature_list]
+    scenario_boundary_array = _get_feature_boundaries(scenario_feature_list)
+
     for raster_path in args.raster_path_list:
         LOGGER.info(f'processing base raster {raster_path}')
         basename = os.path.splitext(os.path.basename(raster_path))[0]
-        churn_dir = os.path.join(args.workspace_dir, f'churn')
-        _makedirs(churn_dir)
 
-        scenario_vector = gdal.OpenEx(
-            args.scenarios_vector_path, gdal.OF_VECTOR)
-        scenario_layer = scenario_vector.GetLayer()
-
-        parcel_mask_raster_path = os.path.join(
-            churn_dir, f'parcel_mask_{basename}.tif')
+        # base and target are read/written in lockstep, the mask is a packed
+        # array outside the GDAL cache, so leave room for a full row of
+        # target tiles of each
+        raster_info = _get_raster_info(raster_path)
+        block_xsize, block_ysize = TARGET_BLOCK_SIZE
+        blocks_per_row = -(-raster_info['raster_size'][0] // block_xsize)
+        block_bytes = block_xsize * block_ysize * (
+            gdal.GetDataTypeSize(raster_info['datatype']) // 8)
+        gdal.SetCacheMax(max(
+            GDAL_CACHE_MAX, blocks_per_row * block_bytes * 2))
 
         # Create a vector mask
         LOGGER.info(
             f'rasterizing parcels from: \n\t{args.parcels_vector_path} ON '
-            f'\n\t{raster_path} TO \n\t{parcel_mask_raster_path}')
-        pygeoprocessing.new_raster_from_base(
-            raster_path, parcel_mask_raster_path, gdal.GDT_Byte, [0])
-        pygeoprocessing.rasterize(
-            args.parcels_vector_path, parcel_mask_raster_path, burn_values=[1])
-
-        for scenario_feature in scenario_layer:
-            scenario_id = scenario_feature.GetField(args.scenario_id_field)
-            LOGGER.info(
-                f'extracting scenario array for scenario "{scenario_id}"')
-            scenario_array = _extract_intersecting_array_from_raster(
-                scenario_feature, scenario_vector_info['projection_wkt'],
-                raster_path)
+            f'\n\t{raster_path}')
+        parcel_mask = _create_vector_mask(
+            raster_path, args.parcels_vector_path)
+
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+        raster_gt_inv = gdal.InvGeoTransform(raster_info['geotransform'])
+        scenario_window_list = [
+            _get_intersecting_window(
+                scenario_boundary, scenario_vector_info['projection_wkt'],
+                raster_info['projection_wkt'], raster_gt_inv)
+            for scenario_boundary in scenario_boundary_array]
+        LOGGER.info(
+            f'extracting {len(scenario_window_list)} scenario arrays')
+        scenario_array_list = _read_windows(raster, scenario_window_list)
 
+        for scenario_id, scenario_array in zip(
+                scenario_id_list, scenario_array_list):
             target_raster_path = os.path.join(
                 args.workspace_dir, f'{basename}_{scenario_id}.tif')
             LOGGER.info(
                 f'wallpapering "{basename}" raster for '
                 f'scenario "{scenario_id}"')
             _wallpaper_raster(
-                raster_path, parcel_mask_raster_path, scenario_array,
+                raster_path, parcel_mask, scenario_array,
                 target_raster_path)
 
 